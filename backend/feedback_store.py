@@ -0,0 +1,46 @@
+# feedback_store.py
+# Persists tokenized feedback incrementally as Arrow shards so fine-tuning
+# can memory-map the training rows instead of reparsing the JSONL history
+
+import os
+import time
+import pyarrow as pa
+
+class FeedbackStore:
+    def __init__(self, directory: str = "data/feedback_arrow"):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._writer = None
+        self._sink = None
+
+    def append(self, input_ids: list, attention_mask: list):
+        # One record batch per feedback item, appended to the open shard.
+        batch = pa.record_batch({
+            "input_ids": pa.array([input_ids], type=pa.list_(pa.int32())),
+            "attention_mask": pa.array([attention_mask], type=pa.list_(pa.int8())),
+        })
+        if self._writer is None:
+            shard_path = os.path.join(
+                self.directory, f"shard_{int(time.time())}_{os.getpid()}.arrow"
+            )
+            self._sink = pa.OSFile(shard_path, "wb")
+            self._writer = pa.ipc.new_stream(self._sink, batch.schema)
+        self._writer.write_batch(batch)
+        self._sink.flush()
+
+    def finalize(self):
+        # Close the open shard so its end-of-stream marker is written and
+        # readers see a complete file; the next append starts a new shard.
+        if self._writer is not None:
+            self._writer.close()
+            self._sink.close()
+            self._writer = None
+            self._sink = None
+
+    def shard_paths(self) -> list:
+        self.finalize()
+        return sorted(
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.endswith(".arrow")
+        )
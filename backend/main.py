@@ -1,16 +1,35 @@
 # main.py
 # FastAPI server for SEAL-Sim - handles prompt generation, feedback, and triggering fine-tuning
 
+import os
+
+# Must be set before torch is imported (model_handler below pulls it in):
+# expandable segments let the allocator grow in place instead of
+# fragmenting when fine-tune and inference buffers alternate on one GPU.
+os.environ.setdefault(
+    "PYTORCH_CUDA_ALLOC_CONF",
+    "expandable_segments:True,max_split_size_mb:512,garbage_collection_threshold:0.8",
+)
+
+import asyncio
+import collections
+import gc
 import json
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import aiofiles
+import torch
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import uvicorn
-import os
 
 from model_handler import ModelHandler
 from seal_policy import SEALPolicy
-from fine_tuner import trigger_fine_tuning
+from feedback_store import FeedbackStore
+from fine_tuner import trigger_fine_tuning, format_feedback
 
 app = FastAPI()
 
@@ -24,29 +43,95 @@ app.add_middleware(
 
 model_handler = ModelHandler()
 seal_policy = SEALPolicy(feedback_threshold=3)
-ADAPTATION_LOG = []
+feedback_store = FeedbackStore()
+# Bounded in-process view of the adaptation history; the full history is
+# streamed to ADAPTATION_LOG_FILE so get_status payloads stay small.
+ADAPTATION_LOG = collections.deque(maxlen=256)
+ADAPTATION_LOG_FILE = "data/adaptation.log.jsonl"
+ADAPTATION_BLOCK = 0
 FEEDBACK_POOL = []
+GENERATE_QUEUE: asyncio.Queue = asyncio.Queue()
+GENERATE_MAX_BATCH = 8
+GENERATE_MAX_WAIT_MS = 10
+ADAPT_LOCK = asyncio.Lock()
+# A single one-thread pool keeps the event loop free while serializing all
+# GPU work: fine-tuning mutates the live module tree in place, so it must
+# never overlap with a generate call on the same model.
+GPU_POOL = ThreadPoolExecutor(max_workers=1)
+FEEDBACK_FILE = "data/feedback.jsonl"
+FEEDBACK_FLUSH_EVERY = 16
+FEEDBACK_FH = None
+FEEDBACK_WRITES_PENDING = 0
 
 class GenerateRequest(BaseModel):
     prompt: str
+    stream: bool = False
 
 class FeedbackRequest(BaseModel):
     prompt: str
     original_completion: str
     corrected_completion: str
 
+async def generate_batch_worker():
+    # Coalesce concurrent /api/generate calls into one batched generate so
+    # N sequential decode loops collapse into a single left-padded pass.
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await GENERATE_QUEUE.get()]
+        deadline = loop.time() + GENERATE_MAX_WAIT_MS / 1000
+        while len(batch) < GENERATE_MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(GENERATE_QUEUE.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        try:
+            completions = await loop.run_in_executor(
+                GPU_POOL, model_handler.generate_batch, [prompt for prompt, _ in batch]
+            )
+        except Exception as exc:
+            # Fail this batch's waiters but keep the worker alive;
+            # otherwise every later request would hang on an unresolved
+            # future.
+            print(f"Batched generation failed: {exc}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            continue
+
+        for (_, future), completion in zip(batch, completions):
+            if not future.done():
+                future.set_result(completion)
+
 @app.on_event("startup")
 async def startup_event():
+    # One persistent buffered handle instead of an open/close per feedback
+    # submission; writes are flushed every FEEDBACK_FLUSH_EVERY entries.
+    global FEEDBACK_FH
+    FEEDBACK_FH = await aiofiles.open(FEEDBACK_FILE, "a", buffering=1 << 16)
+
     print("Loading AI model...")
-    model_handler.load_model()
+    await asyncio.get_running_loop().run_in_executor(GPU_POOL, model_handler.load_model)
     print("AI model loaded successfully.")
+    asyncio.create_task(generate_batch_worker())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Write the open shard's end-of-stream marker so it stays readable
+    # after a restart.
+    feedback_store.finalize()
+    if FEEDBACK_FH is not None:
+        await FEEDBACK_FH.close()
 
 @app.get("/api/status")
 def get_status():
     return {
         "model_status": model_handler.get_status(),
         "seal_policy": seal_policy.get_status(),
-        "adaptation_log": ADAPTATION_LOG,
+        "adaptation_log": list(ADAPTATION_LOG),
         "feedback_pool_size": len(FEEDBACK_POOL)
     }
 
@@ -55,9 +140,95 @@ async def generate(request: GenerateRequest):
     if not model_handler.is_ready():
         raise HTTPException(status_code=503, detail="Model is not ready.")
 
-    completion = model_handler.generate(request.prompt)
+    if request.stream:
+        # Tokens reach the client at time-to-first-token instead of after
+        # the full decode; streamed requests bypass the batching queue.
+        streamer = model_handler.generate_stream(request.prompt, executor=GPU_POOL)
+
+        async def token_stream():
+            # The streamer blocks between tokens, so pull from it on a
+            # worker thread to keep the event loop responsive.
+            loop = asyncio.get_running_loop()
+            iterator = iter(streamer)
+            while True:
+                try:
+                    piece = await loop.run_in_executor(None, next, iterator, None)
+                except queue.Empty:
+                    # Streamer timeout: the generation worker died without
+                    # its end signal, so stop the response instead of
+                    # holding the connection (and an executor thread) open.
+                    break
+                if piece is None:
+                    break
+                yield piece
+
+        return StreamingResponse(token_stream(), media_type="text/plain")
+
+    future = asyncio.get_running_loop().create_future()
+    await GENERATE_QUEUE.put((request.prompt, future))
+    completion = await future
     return {"completion": completion}
 
+async def record_adaptation_event(event: str, **extra):
+    global ADAPTATION_BLOCK
+    ADAPTATION_BLOCK += 1
+    entry = {
+        "blockNumber": ADAPTATION_BLOCK,
+        "timestamp": datetime.utcnow().isoformat(),
+        "event": event,
+        **extra,
+    }
+    ADAPTATION_LOG.append(entry)
+    async with aiofiles.open(ADAPTATION_LOG_FILE, "a") as f:
+        await f.write(json.dumps(entry) + "\n")
+
+async def run_adaptation():
+    # Runs as a background task so the submitting HTTP request returns
+    # immediately instead of blocking on a full fine-tune.
+    await record_adaptation_event(
+        "Fine-tuning process initiated.", feedback_count=len(FEEDBACK_POOL)
+    )
+
+    shard_paths = feedback_store.shard_paths()
+
+    def train_and_swap():
+        # Train and swap in one executor job: the swap blocks on GPU work
+        # and mutates the live model, so it must run on the GPU pool, and
+        # doing both in one job means no queued generate can slip in while
+        # the just-trained adapter is active but the model is still in
+        # train mode.
+        path = trigger_fine_tuning(
+            model_handler.get_training_model(), model_handler.tokenizer,
+            FEEDBACK_FILE, shard_paths,
+        )
+        if path and os.path.exists(path):
+            model_handler.swap_adapter(path)
+        return path
+
+    try:
+        new_adapter_path = await asyncio.get_running_loop().run_in_executor(
+            GPU_POOL, train_and_swap
+        )
+    except Exception as exc:
+        # Fall through to the failure branch below so the log gets its
+        # entry and the feedback pool is still cleared.
+        print(f"Fine-tuning raised: {exc}")
+        new_adapter_path = None
+
+    # Hand training-time allocations back to the allocator before
+    # inference resumes on the same GPU.
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+        torch.cuda.ipc_collect()
+
+    if new_adapter_path and os.path.exists(new_adapter_path):
+        await record_adaptation_event(f"Model updated with adapter: {new_adapter_path}")
+    else:
+        await record_adaptation_event("Fine-tuning failed or adapter not found.")
+
+    FEEDBACK_POOL.clear()
+
 @app.post("/api/submit_feedback")
 async def submit_feedback(request: FeedbackRequest):
     feedback_item = {
@@ -65,41 +236,37 @@ async def submit_feedback(request: FeedbackRequest):
         "original_completion": request.original_completion,
         "corrected_completion": request.corrected_completion
     }
-    FEEDBACK_POOL.append(feedback_item)
-
-    with open("data/feedback.jsonl", "a") as f:
-        f.write(json.dumps(feedback_item) + "\n")
-
-    if seal_policy.should_adapt():
-        print("SEAL Policy: Adaptation approved. Triggering fine-tuning.")
-        seal_policy.reset()
-
-        log_entry = {
-            "blockNumber": len(ADAPTATION_LOG) + 1,
-            "timestamp": f"{json.dumps(ADAPTATION_LOG)}",
-            "event": "Fine-tuning process initiated.",
-            "feedback_count": len(FEEDBACK_POOL),
-        }
-        ADAPTATION_LOG.append(log_entry)
-
-        new_adapter_path = trigger_fine_tuning()
-
-        if new_adapter_path and os.path.exists(new_adapter_path):
-            model_handler.load_model(adapter_path=new_adapter_path)
-            ADAPTATION_LOG.append({
-                "blockNumber": len(ADAPTATION_LOG) + 1,
-                "timestamp": f"{json.dumps(ADAPTATION_LOG)}",
-                "event": f"Model updated with adapter: {new_adapter_path}",
-            })
-        else:
-            ADAPTATION_LOG.append({
-                "blockNumber": len(ADAPTATION_LOG) + 1,
-                "timestamp": f"{json.dumps(ADAPTATION_LOG)}",
-                "event": "Fine-tuning failed or adapter not found.",
-            })
-
-        FEEDBACK_POOL.clear()
-        return {"message": "Feedback received. Adaptation triggered and completed."}
+
+    global FEEDBACK_WRITES_PENDING
+    await FEEDBACK_FH.write(json.dumps(feedback_item) + "\n")
+    FEEDBACK_WRITES_PENDING += 1
+    if FEEDBACK_WRITES_PENDING >= FEEDBACK_FLUSH_EVERY:
+        await FEEDBACK_FH.flush()
+        FEEDBACK_WRITES_PENDING = 0
+
+    # Tokenize now and append to the Arrow store so fine-tuning reads
+    # ready-made training rows instead of reparsing the JSONL history.
+    tokenized = model_handler.tokenizer(
+        format_feedback(request.prompt, request.corrected_completion),
+        truncation=True, max_length=512,
+    )
+    feedback_store.append(tokenized["input_ids"], tokenized["attention_mask"])
+
+    # The increment and threshold check happen under one lock so two
+    # concurrent submissions cannot both race past the threshold and
+    # launch simultaneous fine-tunes.
+    async with ADAPT_LOCK:
+        FEEDBACK_POOL.append(feedback_item)
+        seal_policy.record_feedback()
+        if seal_policy.should_adapt():
+            print("SEAL Policy: Adaptation approved. Triggering fine-tuning.")
+            seal_policy.reset()
+            # The trainer reads the file from disk, so force out any
+            # buffered lines before kicking off the fine-tune.
+            await FEEDBACK_FH.flush()
+            FEEDBACK_WRITES_PENDING = 0
+            asyncio.create_task(run_adaptation())
+            return {"message": "Feedback received. Adaptation triggered in background."}
 
     return {"message": f"Feedback received. {seal_policy.feedback_count}/{seal_policy.feedback_threshold} to next adaptation."}
 
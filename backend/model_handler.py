@@ -2,8 +2,12 @@
 # Loads and manages the base model and optional LoRA adapter
 
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, TextIteratorStreamer
 from peft import PeftModel
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+import copy
+import hashlib
 import os
 
 class ModelHandler:
@@ -14,28 +18,70 @@ class ModelHandler:
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.status = "unloaded"
         self.current_adapter = "None"
+        self._cached_prefixes = {}
+        self._pinned_ids = None
+        self._eager_forward = None
+
+    def _use_nvfp4(self) -> bool:
+        # Blackwell-class GPUs (sm_100+) run FP4 matmuls natively, so a
+        # pre-quantized NVFP4 checkpoint avoids the per-layer NF4
+        # dequant-to-half path entirely. Overridable via SEAL_WEIGHT_FORMAT.
+        fmt = os.environ.get("SEAL_WEIGHT_FORMAT", "auto")
+        if fmt == "nvfp4":
+            return True
+        if fmt == "nf4":
+            return False
+        return torch.cuda.is_available() and torch.cuda.get_device_capability() >= (10, 0)
 
     def load_model(self, adapter_path: str = None):
         self.status = "loading"
         print(f"Loading base model: {self.base_model_name} on device: {self.device}")
 
-        quant_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_compute_dtype=torch.float16,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_use_double_quant=True,
-        )
+        # Fetch the (small) tokenizer on a worker thread while the (large)
+        # weight download + quantization runs; both are I/O bound on cold
+        # starts, so overlapping them saves the serialized Hub round-trip.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            tokenizer_future = executor.submit(
+                AutoTokenizer.from_pretrained, self.base_model_name,
+                trust_remote_code=True, use_fast=True
+            )
+
+            if self._use_nvfp4():
+                print("Loading pre-quantized NVFP4 checkpoint for native FP4 tensor cores.")
+                self.model = AutoModelForCausalLM.from_pretrained(
+                    f"{self.base_model_name}-NVFP4",
+                    device_map="auto",
+                    trust_remote_code=True
+                )
+            else:
+                # bf16 compute is more numerically stable for QLoRA on GPUs that
+                # support it and matches the bf16 training path in fine_tuner.
+                use_bf16 = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+                quant_config = BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_compute_dtype=torch.bfloat16 if use_bf16 else torch.float16,
+                    bnb_4bit_quant_type="nf4",
+                    bnb_4bit_use_double_quant=True,
+                )
+                self.model = AutoModelForCausalLM.from_pretrained(
+                    self.base_model_name,
+                    quantization_config=quant_config,
+                    device_map="auto",
+                    trust_remote_code=True
+                )
+
+            self.tokenizer = tokenizer_future.result()
 
-        self.tokenizer = AutoTokenizer.from_pretrained(self.base_model_name, trust_remote_code=True)
         if self.tokenizer.pad_token is None:
             self.tokenizer.pad_token = self.tokenizer.eos_token
 
-        self.model = AutoModelForCausalLM.from_pretrained(
-            self.base_model_name,
-            quantization_config=quant_config,
-            device_map="auto",
-            trust_remote_code=True
-        )
+        # Set once instead of on every generate call.
+        self.model.generation_config.pad_token_id = self.tokenizer.eos_token_id
+
+        if self.device == "cuda":
+            # Staging prompt ids in pinned host memory lets the H2D copy
+            # overlap with kernel launch via non_blocking transfers.
+            self._pinned_ids = torch.empty(1, 1024, dtype=torch.long, pin_memory=True)
 
         if adapter_path and os.path.isdir(adapter_path):
             print(f"Loading adapter from: {adapter_path}")
@@ -45,23 +91,188 @@ class ModelHandler:
             print("No adapter provided. Using base model only.")
             self.current_adapter = "None"
 
+        self._maybe_compile()
+        self._warmup()
         self.status = "ready"
 
-    def generate(self, prompt: str, max_length: int = 100) -> str:
+    def _compile_enabled(self) -> bool:
+        return os.environ.get("SEAL_COMPILE") == "1" and self.device == "cuda"
+
+    def _maybe_compile(self):
+        # Opt-in: compiling while LoRA adapters are still live can trigger
+        # per-layer recompiles, so callers merge the adapter first and this
+        # stays behind a flag. Compile forward rather than the module:
+        # generate() on a compiled module resolves back to the original,
+        # uncompiled forward, making a whole-module wrap a no-op here.
+        if self._compile_enabled():
+            self._eager_forward = self.model.forward
+            self.model.forward = torch.compile(
+                self.model.forward, mode="reduce-overhead", dynamic=True
+            )
+
+    def _warmup(self):
+        # One dummy generate primes cuDNN/attention kernels (and CUDA graph
+        # capture when compiled) so the first real request pays no setup cost.
+        if self.device != "cuda":
+            return
+        with torch.inference_mode():
+            self.model.generate(
+                torch.zeros(1, 4, dtype=torch.long, device=self.device),
+                max_new_tokens=4,
+            )
+
+    def swap_adapter(self, adapter_path: str):
+        # Swap LoRA adapters in place: the quantized base weights (the bulk
+        # of VRAM) stay resident, so an adaptation cycle only pays for the
+        # small adapter tensors instead of a full reload.
+        print(f"Swapping in adapter from: {adapter_path}")
+        model = self.get_training_model()
+        if isinstance(model, PeftModel):
+            model.load_adapter(adapter_path, adapter_name=adapter_path)
+            model.set_adapter(adapter_path)
+        else:
+            model = PeftModel.from_pretrained(model, adapter_path)
+        if self._compile_enabled():
+            # Merge the now-final adapter so the compiled graph sees static
+            # weights instead of recompiling around live LoRA layers.
+            model.merge_adapter()
+        # The Trainer leaves the shared model in train mode with gradient
+        # checkpointing on; undo both so serving is deterministic (no LoRA
+        # dropout) and doesn't recompute activations.
+        model.eval()
+        if hasattr(model, "gradient_checkpointing_disable"):
+            model.gradient_checkpointing_disable()
+        self.model = model
+        self._maybe_compile()
+        self._warmup()
+        self.current_adapter = adapter_path
+        # Cached prefix KVs were computed with the old weights.
+        self._cached_prefixes.clear()
+
+    def get_training_model(self):
+        # The fine-tuner needs the eager, unmerged module: the compiled
+        # forward and merged LoRA deltas are strictly for inference.
+        model = self.model
+        if self._eager_forward is not None:
+            model.forward = self._eager_forward
+            self._eager_forward = None
+        if isinstance(model, PeftModel):
+            model.unmerge_adapter()
+        return model
+
+    def cache_prefix(self, prefix: str) -> str:
+        # Prefill a shared prefix (system prompt, few-shot header) once and
+        # keep its KV cache; generate() can then skip that prefill entirely.
+        prefix_id = hashlib.sha1(prefix.encode()).hexdigest()[:12]
+        if prefix_id in self._cached_prefixes:
+            return prefix_id
+
+        prefix_ids = self.tokenizer(prefix, return_tensors="pt").input_ids.to(self.device)
+        with torch.inference_mode():
+            outputs = self.model(input_ids=prefix_ids, use_cache=True)
+        self._cached_prefixes[prefix_id] = (prefix_ids, outputs.past_key_values)
+        return prefix_id
+
+    def generate(self, prompt: str, max_new_tokens: int = 100, prefix_id: str = None) -> str:
         if not self.is_ready():
             return "Model not ready."
 
-        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
-        with torch.no_grad():
+        if prefix_id is not None and prefix_id in self._cached_prefixes:
+            prefix_ids, past_key_values = self._cached_prefixes[prefix_id]
+            suffix_ids = self.tokenizer(prompt, return_tensors="pt").input_ids.to(self.device)
+            input_ids = torch.cat([prefix_ids, suffix_ids], dim=1)
+            inputs = {
+                "input_ids": input_ids,
+                "attention_mask": torch.ones_like(input_ids),
+                # Copy so generate's in-place cache growth does not corrupt
+                # the stored prefix cache for the next request.
+                "past_key_values": copy.deepcopy(past_key_values),
+            }
+        else:
+            inputs = self._prepare_inputs(prompt)
+
+        with torch.inference_mode():
             outputs = self.model.generate(
                 **inputs,
-                max_length=max_length,
+                max_new_tokens=max_new_tokens,
+                use_cache=True,
                 temperature=0.7,
                 do_sample=True,
-                pad_token_id=self.tokenizer.eos_token_id
             )
         return self.tokenizer.decode(outputs[0], skip_special_tokens=True)
 
+    def _prepare_inputs(self, prompt: str) -> dict:
+        # Stage the prompt ids in the pinned host buffer when they fit so
+        # the copy to the GPU can overlap with kernel launch.
+        encoded = self.tokenizer(prompt, return_tensors="pt")
+        input_ids = encoded["input_ids"]
+        if self._pinned_ids is not None and input_ids.shape[1] <= self._pinned_ids.shape[1]:
+            length = input_ids.shape[1]
+            self._pinned_ids[:, :length].copy_(input_ids)
+            input_ids = self._pinned_ids[:, :length].to(self.device, non_blocking=True)
+            return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+        return dict(encoded.to(self.device))
+
+    def generate_stream(self, prompt: str, max_new_tokens: int = 100, executor=None) -> TextIteratorStreamer:
+        # Generation runs on a worker thread while the returned streamer
+        # yields text pieces as they decode, so callers can start sending
+        # tokens at time-to-first-token instead of after the full decode.
+        # Skip the shared pinned staging buffer here: this method returns
+        # before the worker consumes the copy, so the next streamed request
+        # could overwrite the buffer mid-flight.
+        inputs = dict(self.tokenizer(prompt, return_tensors="pt").to(self.device))
+        # The timeout bounds how long a consumer can block on the next
+        # token if the worker dies without delivering its end signal.
+        streamer = TextIteratorStreamer(
+            self.tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=120.0
+        )
+        kwargs = dict(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            use_cache=True,
+            temperature=0.7,
+            do_sample=True,
+            streamer=streamer,
+        )
+        # Run the generate on the caller's executor when given so streamed
+        # requests serialize with the rest of the GPU work (fine-tunes,
+        # batched generates) instead of racing them on a raw thread.
+        if executor is not None:
+            executor.submit(self._generate_stream_worker, kwargs)
+        else:
+            Thread(target=self._generate_stream_worker, args=(kwargs,), daemon=True).start()
+        return streamer
+
+    def _generate_stream_worker(self, kwargs):
+        streamer = kwargs["streamer"]
+        try:
+            with torch.inference_mode():
+                self.model.generate(**kwargs)
+        except Exception as exc:
+            # Deliver the end signal so the consumer terminates instead of
+            # blocking until the streamer timeout.
+            print(f"Streaming generation failed: {exc}")
+            streamer.end()
+
+    def generate_batch(self, prompts: list, max_new_tokens: int = 100) -> list:
+        # Run several prompts through a single generate call with left
+        # padding so the decode loops share one KV-cache allocation.
+        if not self.is_ready():
+            return ["Model not ready."] * len(prompts)
+
+        inputs = self.tokenizer(
+            prompts, return_tensors="pt", padding=True, padding_side="left"
+        ).to(self.device)
+        with torch.inference_mode():
+            outputs = self.model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                use_cache=True,
+                temperature=0.7,
+                do_sample=True,
+            )
+        return [self.tokenizer.decode(o, skip_special_tokens=True) for o in outputs]
+
     def is_ready(self):
         return self.status == "ready"
 
@@ -6,8 +6,10 @@ class SEALPolicy:
         self.feedback_threshold = feedback_threshold
         self.feedback_count = 0
 
-    def should_adapt(self) -> bool:
+    def record_feedback(self):
         self.feedback_count += 1
+
+    def should_adapt(self) -> bool:
         return self.feedback_count >= self.feedback_threshold
 
     def reset(self):